@@ -4,7 +4,9 @@ import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:postgres@db:5432/postgres")
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+SQL_ECHO = os.getenv("SQL_ECHO", "0") == "1"
+
+engine = create_async_engine(DATABASE_URL, echo=SQL_ECHO, pool_size=20, max_overflow=10)
 
 SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
 
@@ -1,21 +1,25 @@
-import io
+import asyncio
 import os
+import shutil
 from contextlib import asynccontextmanager
-from typing import List
+from dataclasses import dataclass
+from typing import BinaryIO, List, Optional
 
-import aiofiles
+import cv2
 import httpx
+import numpy as np
 import pydicom
-from PIL import Image as PILImage
 from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Path
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import column, func, insert, table
+from sqlalchemy.dialects.postgresql import Insert, insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import joinedload, selectinload
 
 from database import get_db, engine, Base
 from model import Patient, Study, Image
-from schema import StudySchema
+from schema import StudySchema, StudyListAdapter
 
 
 @asynccontextmanager
@@ -26,9 +30,10 @@ async def lifespan(app: FastAPI):
     print("Database tables checked/created.")
     yield
     print("Application shutdown: Cleaning up...")
+    await SCORING_CLIENT.aclose()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 PROJECT_ROOT = os.path.abspath(os.path.dirname(__file__))
 STORAGE_DIR = os.path.join(os.path.dirname(PROJECT_ROOT), "storage")
@@ -39,214 +44,385 @@ os.makedirs(DICOM_DIR, exist_ok=True)
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
 SCORING_API_URL = "http://apitest.mediwhale.net/predict"
+FILE_PROCESSING_CONCURRENCY = 8
+PNG_COMPRESS_LEVEL = 1
+DICOM_COPY_CHUNK_SIZE = 1024 * 1024
+IMAGE_COPY_THRESHOLD = 100
+IMAGE_COPY_COLUMNS = ["study_key", "image_uid", "laterality", "score", "image_path"]
+IMAGE_STAGING_TABLE = "image_staging"
+SCORING_CONCURRENCY = 32
+
+TAG_SOP_INSTANCE_UID = 0x00080018
+TAG_STUDY_DATE = 0x00080020
+TAG_PATIENT_ID = 0x00100020
+TAG_PATIENT_BIRTH_DATE = 0x00100030
+TAG_PATIENT_SEX = 0x00100040
+TAG_PATIENT_AGE = 0x00101010
+TAG_STUDY_INSTANCE_UID = 0x0020000D
+TAG_STUDY_ID = 0x00200010
+TAG_LATERALITY = 0x00200060
+
+REQUIRED_TAG_LABELS = {
+    "study_date": "StudyDate (0008,0020)",
+    "patient_id": "PatientID (0010,0020)",
+    "patient_birth_date": "PatientBirthDate (0010,0030)",
+    "patient_sex": "PatientSex (0010,0040)",
+    "laterality": "Laterality (0020,0060)",
+}
+
+SCORING_CLIENT = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=SCORING_CONCURRENCY, max_keepalive_connections=16)
+)
+# Scoring calls queue here rather than on the connection pool, so a burst never hits the pool timeout.
+SCORING_SEMAPHORE = asyncio.Semaphore(SCORING_CONCURRENCY)
+
+
+@dataclass(slots=True, frozen=True)
+class DicomTags:
+    study_id: Optional[str]
+    study_uid: Optional[str]
+    study_date: Optional[str]
+    patient_id: Optional[str]
+    patient_birth_date: Optional[str]
+    patient_sex: Optional[str]
+    patient_age: Optional[str]
+    laterality: Optional[str]
+    image_uid: Optional[str]
+
+
+@dataclass(slots=True, frozen=True)
+class ProcessedFile:
+    tags: DicomTags
+    file_name: str
+    image_path: str
+    score: float
+
+
+def _write_upload(dicom_path: str, dicom_source: BinaryIO,
+                  image_path: Optional[str], image_bytes: Optional[bytes]) -> bool:
+    # Exclusive create replaces a separate exists() check; an existing DICOM is left untouched.
+    try:
+        with open(dicom_path, 'xb') as out_file:
+            dicom_source.seek(0)
+            shutil.copyfileobj(dicom_source, out_file, DICOM_COPY_CHUNK_SIZE)
+        dicom_written = True
+    except FileExistsError:
+        dicom_written = False
+
+    if image_path:
+        with open(image_path, 'wb') as out_file:
+            out_file.write(image_bytes)
+
+    return dicom_written
+
+
+def _tag_value(ds: pydicom.Dataset, tag: int):
+    return ds[tag].value if tag in ds else None
+
+
+def _extract_required_tags(ds: pydicom.Dataset) -> DicomTags:
+    return DicomTags(
+        study_id=_tag_value(ds, TAG_STUDY_ID),
+        study_uid=_tag_value(ds, TAG_STUDY_INSTANCE_UID),
+        study_date=_tag_value(ds, TAG_STUDY_DATE),
+        patient_id=_tag_value(ds, TAG_PATIENT_ID),
+        patient_birth_date=_tag_value(ds, TAG_PATIENT_BIRTH_DATE),
+        patient_sex=_tag_value(ds, TAG_PATIENT_SEX),
+        patient_age=_tag_value(ds, TAG_PATIENT_AGE),
+        laterality=_tag_value(ds, TAG_LATERALITY),
+        image_uid=_tag_value(ds, TAG_SOP_INSTANCE_UID)
+    )
 
 
-@app.post("/dicom-web/study/{study_id}")
-async def store_study(
-        study_id: str = Path(...,
-                             description="The StudyID (0020,0010) that all DICOM files in this request must belong to"),
-        files: List[UploadFile] = File(...),
-        db: AsyncSession = Depends(get_db)
-):
-    stored_files_info = []
+def _read_header(source: BinaryIO) -> DicomTags:
+    source.seek(0)
+    return _extract_required_tags(pydicom.dcmread(source, force=True, stop_before_pixels=True))
+
+
+def _decode_and_encode(source: BinaryIO, source_name: str) -> Optional[bytes]:
+    try:
+        source.seek(0)
+        ds = pydicom.dcmread(source, force=True)
+
+        if "PixelData" not in ds:
+            print(f"No pixel data found in DICOM file {source_name}. Skipping image extraction and scoring.")
+            return None
+
+        pixel_array = ds.pixel_array
+        if pixel_array.dtype != np.uint8:
+            pixel_array = pixel_array.astype(np.float32, copy=False)
+            pixel_min = pixel_array.min()
+            pixel_range = pixel_array.max() - pixel_min
+            np.subtract(pixel_array, pixel_min, out=pixel_array)
+            if pixel_range:
+                np.multiply(pixel_array, 255.0 / pixel_range, out=pixel_array)
+            pixel_array = pixel_array.astype(np.uint8, copy=False)
+
+        if pixel_array.ndim == 3 and pixel_array.shape[-1] == 3:
+            pixel_array = cv2.cvtColor(pixel_array, cv2.COLOR_RGB2BGR)
+
+        ok, encoded_image = cv2.imencode(".png", pixel_array, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESS_LEVEL])
+        if not ok:
+            raise ValueError("PNG encoding failed")
+        return encoded_image.tobytes()
+    except Exception as e:
+        print(f"Error extracting and saving pixel data for {source_name}: {str(e)}")
+        return None
+
 
-    for file in files:
+async def _score_image(image_filename: str, image_bytes: bytes, image_uid: str, source_name: str) -> float:
+    try:
+        files_to_predict = {
+            'file': (image_filename, image_bytes, 'image/png')
+        }
+        async with SCORING_SEMAPHORE:
+            response = await SCORING_CLIENT.post(
+                SCORING_API_URL,
+                files=files_to_predict
+            )
+        response.raise_for_status()
+        scoring_result = response.json()
+        image_score = scoring_result.get("score")
+
+        if image_score is None:
+            print(f"Warning: Scoring API did not return a 'score' for {image_uid}. Response: {scoring_result}")
+            return 0.0
+
+        print(f"Received score for {image_uid}: {image_score}")
+        return image_score
+
+    except httpx.RequestError as e:
+        print(f"Error making request to scoring API for {source_name}: {e}")
+        return 0.0
+    except Exception as e:
+        print(f"Error processing scoring API response for {source_name}: {e}")
+        return 0.0
+
+
+async def _validate_one(file: UploadFile, study_id: str, semaphore: asyncio.Semaphore) -> DicomTags:
+    async with semaphore:
         if file.content_type != "application/dicom":
             raise HTTPException(status_code=415,
                                 detail=f"Unsupported Media Type for {file.filename}. Only application/dicom is accepted.")
 
-        content = await file.read()
-
+        # The upload is read straight from its spooled temporary file rather than copied into memory.
         try:
-            dicom_file_like = io.BytesIO(content)
-            ds = pydicom.dcmread(dicom_file_like, force=True)
+            tags = await asyncio.to_thread(_read_header, file.file)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid DICOM file {file.filename}: {str(e)}")
 
-        dcm_study_id = ds.get("StudyID")
-
-        if not dcm_study_id or dcm_study_id != study_id:
-            raise HTTPException(status_code=400,
-                                detail=f"Mismatched StudyID for file {file.filename}. Path parameter '{study_id}' does not match DICOM StudyID '{dcm_study_id}'. All files must belong to the specified study_id.")
-
-        dcm_study_date = ds.get("StudyDate")
-        dcm_patient_id = ds.get("PatientID")
-        dcm_patient_birth_date = ds.get("PatientBirthDate")
-        dcm_patient_sex = ds.get("PatientSex")
-        dcm_laterality = ds.get("Laterality")
-
-        if not dcm_study_date:
-            raise HTTPException(status_code=400,
-                                detail=f"DICOM file {file.filename} is missing StudyDate (0008, 0020).")
-        if not dcm_patient_id:
-            raise HTTPException(status_code=400,
-                                detail=f"DICOM file {file.filename} is missing PatientID (0010,0020).")
-        if not dcm_patient_birth_date:
-            raise HTTPException(status_code=400,
-                                detail=f"DICOM file {file.filename} is missing PatientBirthDate (0010,0030).")
-        if not dcm_patient_sex:
-            raise HTTPException(status_code=400,
-                                detail=f"DICOM file {file.filename} is missing PatientSex (0010,0040).")
-        if not dcm_laterality:
-            raise HTTPException(status_code=400,
-                                detail=f"DICOM file {file.filename} is missing Laterality (0020,0060).")
-
-        dcm_image_uid = ds.get("SOPInstanceUID")
+    if not tags.study_id or tags.study_id != study_id:
+        raise HTTPException(status_code=400,
+                            detail=f"Mismatched StudyID for file {file.filename}. Path parameter '{study_id}' does not match DICOM StudyID '{tags.study_id}'. All files must belong to the specified study_id.")
+
+    missing_tags = [label for field, label in REQUIRED_TAG_LABELS.items() if not getattr(tags, field)]
+    if missing_tags:
+        raise HTTPException(status_code=400,
+                            detail=f"DICOM file {file.filename} is missing {', '.join(missing_tags)}.")
+
+    return tags
+
+
+async def _process_one(file: UploadFile, tags: DicomTags, semaphore: asyncio.Semaphore) -> ProcessedFile:
+    async with semaphore:
+        extracted_image_bytes = await asyncio.to_thread(_decode_and_encode, file.file, file.filename)
+
+        dcm_image_uid = tags.image_uid
         filename = f"{dcm_image_uid}.dcm"
-        filepath = os.path.join(DICOM_DIR, filename)
-        absolute_filepath = os.path.abspath(filepath)
+        absolute_filepath = os.path.join(DICOM_DIR, filename)
 
-        if os.path.exists(absolute_filepath):
+        extracted_image_filename = None
+        absolute_extracted_image_filepath = None
+
+        if extracted_image_bytes:
+            extracted_image_filename = f"{dcm_image_uid}.png"
+            absolute_extracted_image_filepath = os.path.join(IMAGE_DIR, extracted_image_filename)
+
+        dicom_written = await asyncio.to_thread(_write_upload, absolute_filepath, file.file,
+                                                absolute_extracted_image_filepath, extracted_image_bytes)
+
+        if not dicom_written:
             print(
                 f"Warning: File {filename} (SOPInstanceUID: {dcm_image_uid}) already exists. Skipping write to disk, but processing DB.")
-        else:
-            async with aiofiles.open(absolute_filepath, 'wb') as out_file:
-                await out_file.write(content)
+        if extracted_image_filename:
+            print(f"Pixel data extracted and saved as {extracted_image_filename}.")
+
+    # Scoring runs outside the file semaphore; its parallelism is capped by SCORING_SEMAPHORE.
+    if extracted_image_bytes and extracted_image_filename:
+        image_score = await _score_image(extracted_image_filename, extracted_image_bytes, dcm_image_uid,
+                                         file.filename)
+    else:
+        print(f"No extracted image data to send to scoring API for {file.filename}.")
+        image_score = 0.0
+
+    return ProcessedFile(
+        tags=tags,
+        file_name=filename,
+        image_path=absolute_filepath,
+        score=image_score
+    )
 
-        extracted_image_bytes = None
-        extracted_image_filename = None
 
-        if "PixelData" in ds:
-            try:
-                pixel_array = ds.pixel_array
-                if pixel_array.dtype != 'uint8':
-                    pixel_array = (pixel_array - pixel_array.min()) / (pixel_array.max() - pixel_array.min())
-                    pixel_array = (pixel_array * 255).astype('uint8')
+def _upsert_images(stmt: Insert) -> Insert:
+    # Re-uploaded images keep their key and study, and only refresh score and path.
+    return stmt.on_conflict_do_update(
+        index_elements=[Image.image_uid],
+        set_={
+            "score": stmt.excluded.score,
+            "image_path": stmt.excluded.image_path,
+            "updated_date": func.now()
+        }
+    ).returning(Image.image_uid, Image.image_key)
 
-                pil_image = PILImage.fromarray(pixel_array)
 
-                extracted_image_filename = f"{dcm_image_uid}.png"
-                extracted_image_filepath = os.path.join(IMAGE_DIR, extracted_image_filename)
-                absolute_extracted_image_filepath = os.path.abspath(extracted_image_filepath)
+@app.post("/dicom-web/study/{study_id}")
+async def store_study(
+        study_id: str = Path(...,
+                             description="The StudyID (0020,0010) that all DICOM files in this request must belong to"),
+        files: List[UploadFile] = File(...),
+        db: AsyncSession = Depends(get_db)
+):
+    semaphore = asyncio.Semaphore(FILE_PROCESSING_CONCURRENCY)
 
-                pil_image.save(absolute_extracted_image_filepath, format="PNG")
-                print(f"Pixel data extracted and saved as {extracted_image_filename}.")
+    # Every header is validated before any file is decoded, written or scored,
+    # so a rejected request leaves nothing on disk and makes no scoring calls.
+    validations = await asyncio.gather(*(_validate_one(file, study_id, semaphore) for file in files),
+                                       return_exceptions=True)
+    for validation in validations:
+        if isinstance(validation, BaseException):
+            raise validation
 
-                img_byte_arr = io.BytesIO()
-                pil_image.save(img_byte_arr, format="PNG")
-                extracted_image_bytes = img_byte_arr.getvalue()
+    # Decoding, disk writes and scoring run concurrently per file; the AsyncSession
+    # cannot be shared between concurrent tasks, so DB work stays sequential below.
+    results = await asyncio.gather(*(_process_one(file, tags, semaphore) for file, tags in zip(files, validations)),
+                                   return_exceptions=True)
 
-            except Exception as e:
-                print(f"Error extracting and saving pixel data for {file.filename}: {str(e)}")
-        else:
-            print(f"No pixel data found in DICOM file {file.filename}. Skipping image extraction and scoring.")
-
-        image_score = None
-        if extracted_image_bytes and extracted_image_filename:
-            try:
-                async with httpx.AsyncClient() as client:
-                    files_to_predict = {
-                        'file': (extracted_image_filename, extracted_image_bytes, 'image/png')
-                    }
-                    response = await client.post(
-                        SCORING_API_URL,
-                        files=files_to_predict
-                    )
-                    response.raise_for_status()
-                    scoring_result = response.json()
-                    image_score = scoring_result.get("score")
-
-                    if image_score is None:
-                        print(
-                            f"Warning: Scoring API did not return a 'score' for {dcm_image_uid}. Response: {scoring_result}")
-                        image_score = 0.0
-                    else:
-                        print(f"Received score for {dcm_image_uid}: {image_score}")
-
-            except httpx.RequestError as e:
-                print(f"Error making request to scoring API for {file.filename}: {e}")
-                image_score = 0.0
-            except Exception as e:
-                print(f"Error processing scoring API response for {file.filename}: {e}")
-                image_score = 0.0
-        else:
-            print(f"No extracted image data to send to scoring API for {file.filename}.")
-            image_score = 0.0
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    try:
+        patient_ids = {result.tags.patient_id for result in results}
+
+        patient_keys = dict((await db.execute(
+            select(Patient.patient_id, Patient.patient_key).where(Patient.patient_id.in_(patient_ids))
+        )).all())
+        study_key = (await db.execute(select(Study.study_key).where(Study.study_id == study_id))).scalar()
 
         # Patient
-        patient = (await db.execute(select(Patient).where(Patient.patient_id == dcm_patient_id))).scalars().first()
-        if not patient:
-            patient = Patient(
-                patient_id=dcm_patient_id,
-                patient_sex=dcm_patient_sex,
-                patient_birth_date=dcm_patient_birth_date,
-                patient_age=ds.get("PatientAge")
-            )
-            db.add(patient)
-            await db.flush()
-            print(f"New Patient '{dcm_patient_id}' created.")
+        new_patients = {}
+        for result in results:
+            tags = result.tags
+            dcm_patient_id = tags.patient_id
+            if dcm_patient_id not in patient_keys and dcm_patient_id not in new_patients:
+                new_patients[dcm_patient_id] = {
+                    "patient_id": dcm_patient_id,
+                    "patient_sex": tags.patient_sex,
+                    "patient_birth_date": tags.patient_birth_date,
+                    "patient_age": tags.patient_age
+                }
+                print(f"New Patient '{dcm_patient_id}' created.")
+
+        if new_patients:
+            patient_keys.update((await db.execute(
+                insert(Patient).returning(Patient.patient_id, Patient.patient_key),
+                list(new_patients.values())
+            )).all())
 
         # Study
-        study = (await db.execute(select(Study).where(Study.study_id == study_id))).scalars().first()
-        if not study:
-            study = Study(
-                patient_key=patient.patient_key,
-                study_id=study_id,
-                study_uid=ds.get("StudyInstanceUID"),
-                study_date=dcm_study_date,
-                result=0
-            )
-            db.add(study)
-            await db.flush()
+        if study_key is None:
+            tags = results[0].tags
+            study_key = (await db.execute(
+                insert(Study).values(
+                    patient_key=patient_keys[tags.patient_id],
+                    study_id=study_id,
+                    study_uid=tags.study_uid,
+                    study_date=tags.study_date,
+                    result=0
+                ).returning(Study.study_key)
+            )).scalar_one()
             print(f"New Study '{study_id}' created with patient data.")
 
         # Image
-        image = (await db.execute(select(Image).where(
-            Image.image_uid == dcm_image_uid
-        ))).scalars().first()
-
-        if image:
-            image_key_to_return = image.image_key
-            image.score = image_score
-            db.add(image)
-            await db.flush()
-            print(f"Updated Image '{dcm_image_uid}' with new paths and score.")
-        else:
-            image = Image(
-                study_key=study.study_key,
-                image_uid=dcm_image_uid,
-                laterality=dcm_laterality,
-                score=image_score,
-                image_path=absolute_filepath
+        image_rows = {}
+        for result in results:
+            tags = result.tags
+            dcm_image_uid = tags.image_uid
+            image_rows[dcm_image_uid] = {
+                "study_key": study_key,
+                "image_uid": dcm_image_uid,
+                "laterality": tags.laterality,
+                "score": result.score,
+                "image_path": result.image_path
+            }
+            print(f"Image '{dcm_image_uid}' stored for Study '{study_id}' with score: {result.score}.")
+
+        if len(image_rows) >= IMAGE_COPY_THRESHOLD:
+            # COPY cannot upsert, so rows are staged in a temp table and merged with one INSERT ... SELECT.
+            # The staging table only carries the copied columns, without defaults or constraints.
+            connection = await db.connection()
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.execute(
+                f"CREATE TEMP TABLE {IMAGE_STAGING_TABLE} ON COMMIT DROP AS "
+                f"SELECT {', '.join(IMAGE_COPY_COLUMNS)} FROM {Image.__tablename__} WITH NO DATA"
             )
-            db.add(image)
-            await db.flush()
-            print(f"New Image '{dcm_image_uid}' created for Study '{study_id}' with score: {image_score}.")
-            image_key_to_return = image.image_key
-
-        # Commit inside the loop is less efficient but ensures partial data if a file fails later.
-        # For better performance with multiple files, consider committing outside the loop
-        # and rolling back all if any file fails, but that requires more complex error handling.
-        await db.commit()
+            await raw_connection.driver_connection.copy_records_to_table(
+                IMAGE_STAGING_TABLE,
+                records=[tuple(image[name] for name in IMAGE_COPY_COLUMNS) for image in image_rows.values()],
+                columns=IMAGE_COPY_COLUMNS
+            )
+            staged_images = table(IMAGE_STAGING_TABLE, *(column(name) for name in IMAGE_COPY_COLUMNS))
+            image_keys = dict((await db.execute(
+                _upsert_images(pg_insert(Image).from_select(IMAGE_COPY_COLUMNS, select(staged_images)))
+            )).all())
+        else:
+            image_keys = dict((await db.execute(
+                _upsert_images(pg_insert(Image)),
+                list(image_rows.values())
+            )).all())
+
+        stored_files_info = [
+            {
+                "image_key": image_keys[result.tags.image_uid],
+                "file_name": result.file_name,
+                "score": result.score
+            }
+            for result in results
+        ]
 
-        stored_files_info.append({
-            "image_key": image_key_to_return,
-            "file_name": filename,
-            "score": image_score
-        })
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
 
-    return JSONResponse(content={"stored_files": stored_files_info})
+    return ORJSONResponse(content={"stored_files": stored_files_info})
 
 
-@app.get("/dicom-web/study", response_model=List[StudySchema])
+# The rows are validated once here and rendered by orjson, so response_model is dropped to avoid
+# validating every study a second time; responses keeps the schema in the OpenAPI docs.
+@app.get("/dicom-web/study", response_model=None, responses={200: {"model": List[StudySchema]}})
 async def query_studies(db: AsyncSession = Depends(get_db)):
     query = select(Study).options(
-        selectinload(Study.patient),
+        joinedload(Study.patient),
         selectinload(Study.images)
     )
 
     try:
         studies = (await db.execute(query)).scalars().all()
-        return [StudySchema.model_validate(study) for study in studies]
+        content = StudyListAdapter.dump_python(StudyListAdapter.validate_python(studies, from_attributes=True),
+                                               mode="json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database Error: {str(e)}")
 
+    return ORJSONResponse(content=content)
+
 
-@app.get("/dicom-web/study/{study_id}", response_model=StudySchema)
+@app.get("/dicom-web/study/{study_id}", response_model=None, responses={200: {"model": StudySchema}})
 async def query_study(study_id: str = Path(..., description="The ID of the study to retrieve"),
                       db: AsyncSession = Depends(get_db)):
     query = select(Study).options(
-        selectinload(Study.patient),
+        joinedload(Study.patient),
         selectinload(Study.images)
     ).where(Study.study_id == study_id)
 
@@ -258,4 +434,4 @@ async def query_study(study_id: str = Path(..., description="The ID of the study
     if not study:
         raise HTTPException(status_code=404, detail=f"Study with ID '{study_id}' not found.")
 
-    return StudySchema.model_validate(study)
+    return ORJSONResponse(content=StudySchema.model_validate(study).model_dump(mode="json"))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Double, String, DateTime, ForeignKey, func
+from sqlalchemy import Column, Integer, Double, String, DateTime, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -36,6 +36,9 @@ class Study(Base):
 
 class Image(Base):
     __tablename__ = "image"
+    __table_args__ = (
+        Index("ix_image_study_key_image_uid", "study_key", "image_uid"),
+    )
 
     image_key = Column(Integer, primary_key=True, index=True)
     study_key = Column(Integer, ForeignKey("study.study_key", ondelete="CASCADE"), nullable=False)
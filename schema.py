@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 from typing import Optional, List
 from datetime import datetime
 
@@ -11,8 +11,7 @@ class PatientSchema(BaseModel):
     patient_age: Optional[str]
     created_date: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 
 class ImageSchema(BaseModel):
@@ -24,8 +23,7 @@ class ImageSchema(BaseModel):
     created_date: datetime
     updated_date: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 
 class StudySchema(BaseModel):
@@ -40,5 +38,7 @@ class StudySchema(BaseModel):
     patient: PatientSchema
     images: List[ImageSchema] = []
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+
+StudyListAdapter = TypeAdapter(List[StudySchema])
@@ -1,90 +1,165 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
+import mmap
+import struct
 import sys
 import uuid
 import os
-import subprocess
-from datetime import datetime
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+
+STUDY_DATE_TAG = (0x0008, 0x0020)
+PATIENT_ID_TAG = (0x0010, 0x0020)
+PATIENT_BIRTH_DATE_TAG = (0x0010, 0x0030)
+TRANSFER_SYNTAX_UID_TAG = (0x0002, 0x0010)
+FAST_READ_TAGS = {STUDY_DATE_TAG, PATIENT_ID_TAG, PATIENT_BIRTH_DATE_TAG}
+
+# Explicit VRs whose length is stored in 4 bytes after 2 reserved bytes.
+LONG_LENGTH_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+UNSUPPORTED_FAST_READ_SYNTAXES = {
+    "1.2.840.10008.1.2",  # Implicit VR Little Endian
+    "1.2.840.10008.1.2.1.99",  # Deflated Explicit VR Little Endian
+    "1.2.840.10008.1.2.2",  # Explicit VR Big Endian
+}
+
+STUDY_CACHE_FILE = ".study_cache.json"
+
+
+def parse_yyyymmdd(date_str):
+    if len(date_str) != 8 or not date_str.isdigit():
+        raise ValueError(f"Invalid DICOM date: {date_str!r}")
+    return int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8])
 
 
 def get_patient_age(study_date_str, birth_date_str):
-    fmt = "%Y%m%d"
     try:
-        study_date = datetime.strptime(study_date_str, fmt)
-        birth_date = datetime.strptime(birth_date_str, fmt)
+        study_year, study_month, study_day = parse_yyyymmdd(study_date_str)
+        birth_year, birth_month, birth_day = parse_yyyymmdd(birth_date_str)
     except ValueError:
         return "000Y"
-    age = study_date.year - birth_date.year
-    if (study_date.month, study_date.day) < (birth_date.month, birth_date.day):
+    age = study_year - birth_year
+    if (study_month, study_day) < (birth_month, birth_day):
         age -= 1
     return f"{age:03d}Y"
 
 
-def generate_uids():
-    root = "2.25"
-    study_uid = f"{root}.{uuid.uuid4().int}"
-    sop_uid = f"{root}.{uuid.uuid4().int}"
-    return study_uid, sop_uid
+def get_study_id(study_key):
+    # A stable digest (unlike hash(), which is salted per process) keeps StudyIDs the same across runs.
+    digest = hashlib.blake2s(study_key.encode(), digest_size=4).digest()
+    return str(int.from_bytes(digest, "big") % 900000 + 100000)
 
 
-def get_dicom_tag(dcm_file, tag):
+def generate_uids(count):
+    # One urandom read for the whole batch instead of one per uuid4() call.
+    root = "2.25"
+    random_bytes = os.urandom(16 * count)
+    return [f"{root}.{uuid.UUID(bytes=random_bytes[i:i + 16], version=4).int}"
+            for i in range(0, len(random_bytes), 16)]
+
+
+def read_tags_fast(dcm_file):
+    # Walks the explicit VR little endian header directly; anything else raises ValueError
+    # so read_tags can fall back to a full parser.
+    with open(dcm_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[128:132] != b"DICM":
+            raise ValueError("Missing DICM prefix")
+
+        values = {}
+        transfer_syntax = None
+        offset = 132
+        while offset + 8 <= len(mm) and len(values) < len(FAST_READ_TAGS):
+            group, element, vr = struct.unpack_from("<HH2s", mm, offset)
+            if group > 0x0002 and transfer_syntax in UNSUPPORTED_FAST_READ_SYNTAXES:
+                raise ValueError(f"Unsupported transfer syntax {transfer_syntax}")
+            if group > PATIENT_BIRTH_DATE_TAG[0]:
+                break
+            if not (vr.isalpha() and vr.isupper()):
+                raise ValueError("Not an explicit VR element")
+
+            if vr in LONG_LENGTH_VRS:
+                length, = struct.unpack_from("<I", mm, offset + 8)
+                value_offset = offset + 12
+            else:
+                length, = struct.unpack_from("<H", mm, offset + 6)
+                value_offset = offset + 8
+            if length == 0xFFFFFFFF:
+                raise ValueError("Undefined length element")
+
+            if (group, element) == TRANSFER_SYNTAX_UID_TAG:
+                transfer_syntax = mm[value_offset:value_offset + length].rstrip(b"\x00 ").decode("ascii")
+            elif (group, element) in FAST_READ_TAGS:
+                values[(group, element)] = mm[value_offset:value_offset + length].decode("ascii").strip("\x00 ")
+            offset = value_offset + length
+
+    return values.get(STUDY_DATE_TAG), values.get(PATIENT_ID_TAG), values.get(PATIENT_BIRTH_DATE_TAG)
+
+
+def read_tags(dcm_file):
+    try:
+        return read_tags_fast(dcm_file)
+    except (OSError, ValueError, struct.error):
+        pass
+
     try:
-        result = subprocess.run(
-            ["dcmdump", dcm_file],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        for line in result.stdout.splitlines():
-            if tag in line:
-                start = line.find('[')
-                end = line.find(']')
-                if start != -1 and end != -1:
-                    return line[start + 1:end]
-        return None
-    except subprocess.CalledProcessError as e:
-        print(f"Error running dcmdump on {dcm_file}: {e.stderr.decode().strip()}")
-        return None
-    except FileNotFoundError:
-        print(f"Error: 'dcmdump' command not found. Make sure DCMTK is installed and in your PATH.")
-        sys.exit(1)
+        ds = pydicom.dcmread(dcm_file, force=True, stop_before_pixels=True,
+                             specific_tags=[STUDY_DATE_TAG, PATIENT_ID_TAG, PATIENT_BIRTH_DATE_TAG])
+    except Exception as e:
+        print(f"Error reading {dcm_file}: {e}")
+        return None, None, None
+    return ds.get("StudyDate"), ds.get("PatientID"), ds.get("PatientBirthDate")
 
 
 def update_dicom_file(input_file, output_dir, study_id, study_uid, sop_uid, patient_age):
-    os.makedirs(output_dir, exist_ok=True)
     base_name = os.path.basename(input_file)
     output_file = os.path.join(output_dir, base_name)
+    temp_file = output_file + ".tmp"
 
     try:
-        subprocess.run(["cp", input_file, output_file], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error copying {input_file} to {output_file}: {e}")
-        return
-    except FileNotFoundError:
-        print(f"Error: 'cp' command not found. This should not happen on most systems.")
-        sys.exit(1)
-
-    dcmodify_cmd = [
-        "dcmodify", "-nb",
-        f"-i", f"0008,0018={sop_uid}",
-        f"-i", f"0010,1010={patient_age}",
-        f"-i", f"0020,0010={study_id}",
-        f"-i", f"0020,000D={study_uid}",
-        output_file
-    ]
-
+        ds = pydicom.dcmread(input_file, force=True)
+        ds.SOPInstanceUID = sop_uid
+        ds.PatientAge = patient_age
+        ds.StudyID = study_id
+        ds.StudyInstanceUID = study_uid
+        if "MediaStorageSOPInstanceUID" in ds.file_meta:
+            ds.file_meta.MediaStorageSOPInstanceUID = sop_uid
+        # Only a complete rewrite reaches the final name, which is what the "already processed" check relies on.
+        ds.save_as(temp_file)
+        os.replace(temp_file, output_file)
+        return base_name, True
+    except Exception as e:
+        print(f"Error modifying {base_name}: {e}")
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        return base_name, False
+
+
+def update_dicom_file_worker(job):
+    return update_dicom_file(*job)
+
+
+def save_study_cache(cache_path, study_level_info_cache):
+    # Write to a temp file and rename it over the cache, so a crash never leaves a truncated cache.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
     try:
-        subprocess.run(dcmodify_cmd, check=True, capture_output=True)
-        print(f"Processed {base_name}")
-        print(f"  StudyID: {study_id}")
-        print(f"  StudyInstanceUID: {study_uid}")
-        print(f"  SOPInstanceUID: {sop_uid}")
-        print(f"  PatientAge: {patient_age}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error modifying {base_name}: {e.stderr.decode().strip()}")
-    except FileNotFoundError:
-        print("Error: 'dcmodify' command not found. Make sure DCMTK is installed and in your PATH.")
-        sys.exit(1)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(study_level_info_cache, cache_file)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def print_processed(base_name, study_id, study_uid, sop_uid, patient_age):
+    print(f"Processed {base_name}")
+    print(f"  StudyID: {study_id}")
+    print(f"  StudyInstanceUID: {study_uid}")
+    print(f"  SOPInstanceUID: {sop_uid}")
+    print(f"  PatientAge: {patient_age}")
 
 
 def main():
@@ -96,53 +171,73 @@ def main():
 
     os.makedirs(base_output_dir, exist_ok=True)
 
-    # Use a dictionary to cache study-level info (StudyID, StudyInstanceUID, PatientAge)
-    study_level_info_cache = {}
+    # Use a dictionary to cache study-level info (StudyID, StudyInstanceUID, PatientAge).
+    # It is persisted so a re-run keeps the StudyInstanceUIDs of already-written studies.
+    cache_path = os.path.join(base_output_dir, STUDY_CACHE_FILE)
+    if os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            study_level_info_cache = json.load(cache_file)
+    else:
+        study_level_info_cache = {}
 
-    dicom_files = [f for f in os.listdir(input_dir) if f.endswith(".dcm")]
+    with os.scandir(input_dir) as entries:
+        dicom_files = [entry for entry in entries if entry.name.endswith(".dcm") and entry.is_file()]
 
     if not dicom_files:
         print(f"No DICOM files found in '{input_dir}'")
         sys.exit(0)
 
-    for file_name in dicom_files:
-        full_path = os.path.join(input_dir, file_name)
-
-        study_date = get_dicom_tag(full_path, "(0008,0020)")
-        patient_id = get_dicom_tag(full_path, "(0010,0020)")
-        birth_date = get_dicom_tag(full_path, "(0010,0030)")
-
-        if not all([patient_id, birth_date, study_date]):
-            print(f"Skipping {file_name} - missing PatientID, PatientBirthDate, or StudyDate")
-            continue
-
-        study_key = f"{patient_id}|{study_date}"
-
-        if study_key in study_level_info_cache:
-            study_data = study_level_info_cache[study_key]
-        else:
-            study_id = str(abs(hash(study_key)) % 900000 + 100000)
-            study_uid, _ = generate_uids()
-            patient_age = get_patient_age(study_date, birth_date)
-            study_data = {
-                "study_id": study_id,
-                "study_uid": study_uid,
-                "patient_age": patient_age
-            }
-            study_level_info_cache[study_key] = study_data
-
-        _, new_sop_uid = generate_uids()
-
-        output_dir = os.path.join(base_output_dir, study_data["study_id"])
-
-        update_dicom_file(
-            full_path,
-            output_dir,
-            study_data["study_id"],
-            study_data["study_uid"],
-            new_sop_uid,
-            study_data["patient_age"]
-        )
+    paths = [entry.path for entry in dicom_files]
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # Pass 1: read tags in parallel and group files by study.
+        study_files = defaultdict(list)
+        for entry, (study_date, patient_id, birth_date) in zip(
+                dicom_files, executor.map(read_tags, paths, chunksize=32)):
+            if not all([patient_id, birth_date, study_date]):
+                print(f"Skipping {entry.name} - missing PatientID, PatientBirthDate, or StudyDate")
+                continue
+            study_files[(patient_id, study_date)].append((entry.path, birth_date))
+
+        uids = iter(generate_uids(len(study_files) + sum(len(files) for files in study_files.values())))
+
+        jobs = []
+        for (patient_id, study_date), files in study_files.items():
+            study_key = f"{patient_id}|{study_date}"
+            study_data = study_level_info_cache.get(study_key)
+            if study_data is None:
+                study_data = {
+                    "study_id": get_study_id(study_key),
+                    "study_uid": next(uids),
+                    "patient_age": get_patient_age(study_date, files[0][1])
+                }
+                study_level_info_cache[study_key] = study_data
+
+            output_dir = os.path.join(base_output_dir, study_data["study_id"])
+            os.makedirs(output_dir, exist_ok=True)
+
+            for full_path, _ in files:
+                base_name = os.path.basename(full_path)
+                if os.path.exists(os.path.join(output_dir, base_name)):
+                    print(f"Skipping {base_name} - already processed")
+                    continue
+                jobs.append((
+                    full_path,
+                    output_dir,
+                    study_data["study_id"],
+                    study_data["study_uid"],
+                    next(uids),
+                    study_data["patient_age"]
+                ))
+
+        # Saved before any output is written, so an interrupted run still leaves the UIDs it used.
+        save_study_cache(cache_path, study_level_info_cache)
+
+        # Pass 2: files are independent once study-level info is resolved, so they are rewritten in parallel.
+        results = executor.map(update_dicom_file_worker, jobs, chunksize=32)
+        for (_, _, study_id, study_uid, sop_uid, patient_age), (base_name, modified) in zip(jobs, results):
+            if modified:
+                print_processed(base_name, study_id, study_uid, sop_uid, patient_age)
 
     print(f"\nDone. Modified files are in {os.path.abspath(output_dir)}")
 